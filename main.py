@@ -4,12 +4,13 @@ import time
 import math
 import random
 
+from time import perf_counter_ns
 from fractions import Fraction
-from functools import partial
-from itertools import product
+from functools import partial, lru_cache
 from importlib import resources
-from threading import Thread
+from threading import Thread, Event
 
+import numpy as np
 import pygame
 from pygame import display, transform, event, font, Color, Rect, Surface
 from pygame.font import Font
@@ -23,7 +24,26 @@ from vision import LetterRecognizerNN
 
 
 def time_ms():
-    return time.time_ns() // 1_100_000
+    return perf_counter_ns() // 1_000_000
+
+
+# pygame-ce >= 2.1.3 maps event.wait(timeout) to a real SDL_WaitEventTimeout,
+# older releases poll every millisecond while waiting
+BLOCKING_EVENT_WAIT = (getattr(pygame, "IS_CE", False)
+        and pygame.version.vernum >= (2, 1, 3))
+
+def wait_event(timeout):
+    if BLOCKING_EVENT_WAIT:
+        return event.wait(timeout=timeout)
+    deadline = time_ms() + timeout
+    while True:
+        e = event.poll()
+        if e.type != pygame.NOEVENT:
+            return e
+        remaining = deadline - time_ms()
+        if remaining <= 0:
+            return e
+        time.sleep(min(remaining/1000, .005))
 
 
 def get_display_size():
@@ -61,10 +81,14 @@ class TimeController:
         1,
         Fraction( 3,   2),
         2, 3, 4, 8, 16)
+    # (numerator, denominator) of each speed, for integer-only scaling
+    speed_ratios = tuple(
+        (Fraction(s).numerator, Fraction(s).denominator) for s in speeds)
 
     def __init__(self):
         self.speed = 1
         self.speed_index = self.speeds.index(self.speed)
+        self.speed_num, self.speed_den = self.speed_ratios[self.speed_index]
         self.last_reading = None
         self.timestamp = None
 
@@ -72,6 +96,7 @@ class TimeController:
         self.speed_index = max(0, self.speed_index + step)
         self.speed_index = min(len(self.speeds)-1, self.speed_index)
         self.speed = self.speeds[self.speed_index]
+        self.speed_num, self.speed_den = self.speed_ratios[self.speed_index]
 
     def time(self):
         if self.last_reading is None:
@@ -81,7 +106,7 @@ class TimeController:
             t = time_ms()
             dt = t - self.last_reading
             self.last_reading = t
-            self.timestamp += int(dt * self.speed)
+            self.timestamp += dt * self.speed_num // self.speed_den
         return self.timestamp
 
 
@@ -121,7 +146,8 @@ class Clock:
         self.time = time_provider
         self.target = 0
         if freq is not None:
-            self.period = 1000 // freq
+            # Kept fractional so that the long-term average matches freq exactly
+            self.period = 1000 / freq
         elif period is not None:
             self.period = period
         else:
@@ -131,8 +157,11 @@ class Clock:
         self.target = self.time() + self.period
 
     def time_remaining(self):
-        t = self.target - self.time()
-        return t if t >= 0 else 0
+        return max(0, self.target - self.time())
+
+    def spin(self):
+        while self.time() < self.target:
+            pass
 
     def advance(self):
         self.target += self.period
@@ -141,22 +170,25 @@ class Clock:
 class Assets:
     BASE_TILE_SIZE = 16
 
+    # Indices into Assets.tiles
+    DEFAULT_TILE, START_TILE, FINISH_TILE, WALL_TILE_L, WALL_TILE_MR = range(5)
+
     @staticmethod
+    @lru_cache(maxsize=16)
     def image_from_resource(module, res_name):
         with resources.open_binary(module, res_name) as f:
             return pygame.image.load(f)
 
-    @staticmethod
-    def scale(surface, scale):
-        w, h = surface.get_size()
-        return transform.scale(surface, (w*scale, h*scale))
-
     def get_tile(self, surface, x, y):
-        return surface.subsurface(Rect(
-                    x * self.tile_size,
-                    y * self.tile_size,
-                    self.tile_size,
-                    self.tile_size))
+        tile = surface.subsurface(Rect(
+                    x * self.BASE_TILE_SIZE,
+                    y * self.BASE_TILE_SIZE,
+                    self.BASE_TILE_SIZE,
+                    self.BASE_TILE_SIZE))
+        # Scaling also copies the tile out of the (converted) atlas
+        tile = transform.scale(tile, (self.tile_size, self.tile_size))
+        tile.set_colorkey(surface.get_colorkey())
+        return tile
 
     def __init__(self, scale=1):
         self.pixel_size = scale
@@ -166,11 +198,6 @@ class Assets:
         vacuum  = self.image_from_resource(assets, "vacuum.png").convert()
         dirt    = self.image_from_resource(assets, "dirt.png").convert()
 
-        if scale > 1:
-            tileset = self.scale(tileset, scale)
-            vacuum  = self.scale(vacuum, scale)
-            dirt    = self.scale(dirt, scale)
-
         for surface in tileset, vacuum:
             surface.set_colorkey(Color(255, 0, 255))
 
@@ -180,6 +207,13 @@ class Assets:
         self.wall_tile_l  = self.get_tile(tileset, 0, 1)
         self.wall_tile_mr = self.get_tile(tileset, 1, 1)
 
+        self.tiles = [
+                self.default_tile,
+                self.start_tile,
+                self.finish_tile,
+                self.wall_tile_l,
+                self.wall_tile_mr]
+
         self.vacuum = [
                 [self.get_tile(vacuum, j, i) for j in range(2)]
                 for i in range(2)]
@@ -205,12 +239,18 @@ class BaseModule:
         while True:
             while True:
                 wait_time = self.clock.time_remaining()
-                if wait_time > 0:
-                    e = event.wait(wait_time)
-                else:
-                    e = event.poll()
-                if e.type == pygame.NOEVENT:
+                if wait_time < 1:
                     break
+                e = wait_event(int(wait_time))
+                if e.type != pygame.NOEVENT:
+                    self.event(e)
+                    # Handle whatever arrived along with it before waiting again
+                    for e in event.get():
+                        self.event(e)
+            # Busy-wait the sub-millisecond remainder for precise pacing,
+            # then drain whatever is left in the queue in one call
+            self.clock.spin()
+            for e in event.get():
                 self.event(e)
             self.clock.advance()
 
@@ -239,8 +279,7 @@ class SplashScreenModule(BaseModule):
         self.splash_image_asset = splash_image_asset
 
     def start(self):
-        with resources.open_binary(assets, self.splash_image_asset) as f:
-            splash_surface = pygame.image.load(f)
+        splash_surface = Assets.image_from_resource(assets, self.splash_image_asset)
         size = splash_surface.get_size()
         screen = set_mode_if_needed(size)
         screen.blit(splash_surface, (0, 0))
@@ -259,10 +298,12 @@ class ModelLoadingModule(SplashScreenModule):
         super().__init__("load_splash.png")
         self.model_path = model_path
         self.model = None
-        self.thread = Thread(target=self.worker)
+        self.done = Event()
+        self.thread = Thread(target=self.worker, daemon=True)
 
     def worker(self):
         self.model = LetterRecognizerNN(self.model_path)
+        self.done.set()
 
     def start(self):
         super().start()
@@ -270,7 +311,7 @@ class ModelLoadingModule(SplashScreenModule):
         self.thread.start()
 
     def update(self):
-        if not self.thread.is_alive():
+        if self.done.is_set():
             return self.model
 
 
@@ -280,6 +321,7 @@ class ReadingBoardModule(SplashScreenModule):
         self.model = model
         self.board_image_path = board_image_path
         self.board_data = None
+        self.done = Event()
         self.thread = Thread(target=self.worker, daemon=True)
 
     def worker(self):
@@ -287,6 +329,7 @@ class ReadingBoardModule(SplashScreenModule):
         vision.print_board(board, self.model.labels)
         print()
         self.board_data = game.parse_board(self.model.labels, board)
+        self.done.set()
 
     def start(self):
         super().start()
@@ -294,7 +337,7 @@ class ReadingBoardModule(SplashScreenModule):
         self.thread.start()
 
     def update(self):
-        if not self.thread.is_alive():
+        if self.done.is_set():
             return self.board_data
 
 
@@ -307,6 +350,7 @@ class SolvingModule(SplashScreenModule):
         self.final_pos = final_pos
         self.algorithm = algorithm
         self.path = None
+        self.done = Event()
         self.thread = Thread(target=self.worker, daemon=True)
 
     algorithms = {
@@ -321,6 +365,7 @@ class SolvingModule(SplashScreenModule):
         final_state = State(self.final_pos, self.start_dirt*0)
         nodes = solve(self.board_layout, start_state, final_state)
         self.path = game.solution_path(nodes, final_state)
+        self.done.set()
 
     def start(self):
         super().start()
@@ -328,21 +373,23 @@ class SolvingModule(SplashScreenModule):
         self.thread.start()
 
     def update(self):
-        if not self.thread.is_alive():
+        if self.done.is_set():
             return self.path
 
 
 class Dirt:
+    ANIMATION_ROWS = tuple(range(Assets.BASE_TILE_SIZE))
+
     def __init__(self, assets, pos, level, time_provider):
         self.assets = assets
         self.pos = pos
+        self._grid_pos = assets.grid_pos(pos)
         self._level = level
-        self.sprite = assets.dirt[level].copy()
+        self.sprite = assets.dirt[level].convert()
         self.sprite.set_colorkey(Color(255, 0, 255))
         self.animation_timer = Timer(time_provider)
-        self.animation_coords = [(x, y) for x, y in product(range(16), repeat=2)]
-        self.animation_index = len(self.animation_coords)
-        random.shuffle(self.animation_coords)
+        self.animation_rows = random.sample(self.ANIMATION_ROWS, len(self.ANIMATION_ROWS))
+        self.animation_index = len(self.animation_rows)
 
     @property
     def level(self):
@@ -352,45 +399,52 @@ class Dirt:
     def level(self, value):
         self._level = value
         self.animation_index = 0
-        self.animation_timer.set(1000//len(self.animation_coords))
+        self.animation_timer.set(1000//len(self.animation_rows))
         self.animation_timer.start()
 
     def update(self):
-        while (self.animation_index < len(self.animation_coords)
+        first_index = self.animation_index
+        while (self.animation_index < len(self.animation_rows)
                 and self.animation_timer.tick()):
-            x, y = self.animation_coords[self.animation_index]
-            pixel = Rect(
-                    x * self.assets.pixel_size,
-                    y * self.assets.pixel_size,
-                    self.assets.pixel_size,
-                    self.assets.pixel_size)
-            self.sprite.blit(self.assets.dirt[self._level], pixel, pixel)
             self.animation_index += 1
+        if self.animation_index == first_index:
+            return False
+
+        # Reveal every scanline due since the last frame in a single blit batch
+        pixel_size = self.assets.pixel_size
+        tile_size = self.assets.tile_size
+        source = self.assets.dirt[self._level]
+        blit_sequence = []
+        for y in self.animation_rows[first_index:self.animation_index]:
+            row = Rect(0, y * pixel_size, tile_size, pixel_size)
+            blit_sequence.append((source, row, row))
+        self.sprite.blits(blit_sequence, doreturn=False)
+        return True
 
     def render(self, dest_surf):
-        dest_surf.blit(self.sprite, self.assets.grid_pos(self.pos))
+        dest_surf.blit(self.sprite, self._grid_pos)
 
 
 class Vacuum:
+    # Ruffini-Horner of 6x^5 - 15x^4 + 10x^3, sampled over [0, 1]
+    ANIMATION_LUT = tuple(
+            ((6 * x - 15) * x + 10) * x**3
+            for x in (i/255 for i in range(256)))
+
     def __init__(self, assets, pos, time_provider):
         self.assets = assets
         self._pos = pos
         self.old_pos = pos
+        self._grid_pos = assets.grid_pos(pos)
+        self._old_grid_pos = self._grid_pos
+        self._grid_delta = (0, 0)
         self.frame_timer = Timer()
         self.frame_timer.set(500)
         self.frame_timer.start()
         self.move_clock = Clock(period=1000, time_provider=time_provider)
         self.animation_state = 0
         self.animation_frame = 0
-
-    @staticmethod
-    def animation_function(x):
-        if x <= 0:
-            return 0
-        if x >= 1:
-            return 1
-        # Ruffini-Horner of 6x^5 - 15x^4 + 10x^3
-        return ((6 * x - 15) * x + 10) * x**3
+        self.blit_args = (assets.vacuum[0][0], self._grid_pos)
 
     @property
     def pos(self):
@@ -400,6 +454,11 @@ class Vacuum:
     def pos(self, value):
         self.old_pos = self._pos
         self._pos = value
+        self._old_grid_pos = self.assets.grid_pos(self.old_pos)
+        self._grid_pos = self.assets.grid_pos(value)
+        old_x, old_y = self._old_grid_pos
+        x, y = self._grid_pos
+        self._grid_delta = (x-old_x, y-old_y)
         self.animation_state = 0
         self.move_clock.start()
 
@@ -407,38 +466,46 @@ class Vacuum:
         self.animation_state = 1
 
     def update(self):
+        frames = self.assets.vacuum[self.animation_state]
         if self.frame_timer.tick():
-            frames = self.assets.vacuum[self.animation_state]
             self.animation_frame = (self.animation_frame+1) % len(frames)
 
-    def render(self, dest_surf):
-        x, y = self.assets.grid_pos(self._pos)
+        x, y = self._grid_pos
         t = self.move_clock.time_remaining()
 
         if t > 0:
-            old_x, old_y = self.assets.grid_pos(self.old_pos)
-            dx, dy = x-old_x, y-old_y
-            c = self.animation_function(1-t/1000)
+            old_x, old_y = self._old_grid_pos
+            dx, dy = self._grid_delta
+            c = self.ANIMATION_LUT[max(0, 255 - int(t*255)//1000)]
             x = int(old_x + c*dx)
             y = int(old_y + c*dy)
 
-        frames = self.assets.vacuum[self.animation_state]
-        dest_surf.blit(frames[self.animation_frame], (x, y))
+        blit_args = (frames[self.animation_frame], (x, y))
+        changed = blit_args != self.blit_args
+        self.blit_args = blit_args
+        return changed
+
+    def render(self, dest_surf):
+        dest_surf.blit(*self.blit_args)
 
 
 class StatusBar:
     def __init__(self, area):
         self.area = area
         self._left_text = ""
-        self._left_text_surf = None
+        self._center_text = ""
         self._right_text = ""
-        self._right_text_surf = None
+        self._bar_surf = Surface(area.size).convert()
+        self._dirty = True
 
         x, y, w, h = area
         self.padding = int(h*.25)
         with resources.path(assets, "0xA000-Squareish-Mono-Bold.ttf") as font_path:
             self.font = Font(font_path, h - self.padding*2)
 
+        # Texts come from a small fixed set (moves, modes and speeds)
+        self.render_text = lru_cache(maxsize=32)(self.render_text)
+
     @property
     def left_text(self):
         return self._left_text
@@ -446,7 +513,7 @@ class StatusBar:
     @left_text.setter
     def left_text(self, value):
         self._left_text = value
-        self._left_text_surf = None
+        self._dirty = True
 
     @property
     def center_text(self):
@@ -455,7 +522,7 @@ class StatusBar:
     @center_text.setter
     def center_text(self, value):
         self._center_text = value
-        self._center_text_surf = None
+        self._dirty = True
 
     @property
     def right_text(self):
@@ -464,29 +531,32 @@ class StatusBar:
     @right_text.setter
     def right_text(self, value):
         self._right_text = value
-        self._right_text_surf = None
+        self._dirty = True
 
     def render_text(self, text):
         return self.font.render(
                 text, True, Color(0, 0, 0), Color(255, 255, 255))
 
-    def render(self, dest_surf):
-        x, y, w, h = self.area
-        dest_surf.fill(Color(255, 255, 255), self.area)
+    def compose(self):
+        w, h = self.area.size
+        self._bar_surf.fill(Color(255, 255, 255))
         if self._center_text:
-            if self._center_text_surf is None:
-                self._center_text_surf = self.render_text(self._center_text)
-            tw, th = self._center_text_surf.get_size()
-            dest_surf.blit(self._center_text_surf, ((x+w-tw)//2, y+self.padding))
+            text_surf = self.render_text(self._center_text)
+            tw, th = text_surf.get_size()
+            self._bar_surf.blit(text_surf, ((w-tw)//2, self.padding))
         if self._right_text:
-            if self._right_text_surf is None:
-                self._right_text_surf = self.render_text(self._right_text)
-            tw, th = self._right_text_surf.get_size()
-            dest_surf.blit(self._right_text_surf, (x+w-tw-self.padding, y+self.padding))
+            text_surf = self.render_text(self._right_text)
+            tw, th = text_surf.get_size()
+            self._bar_surf.blit(text_surf, (w-tw-self.padding, self.padding))
         if self._left_text:
-            if self._left_text_surf is None:
-                self._left_text_surf = self.render_text(self._left_text)
-            dest_surf.blit(self._left_text_surf, (x+self.padding, y+self.padding))
+            text_surf = self.render_text(self._left_text)
+            self._bar_surf.blit(text_surf, (self.padding, self.padding))
+        self._dirty = False
+
+    def render(self, dest_surf):
+        if self._dirty:
+            self.compose()
+        dest_surf.blit(self._bar_surf, self.area.topleft)
 
 
 class MainGameModule(BaseModule):
@@ -503,9 +573,11 @@ class MainGameModule(BaseModule):
         self.state_advance_timer = Timer(self.time_controller.time)
         self.screen = None
         self.background = None
-        self.dirt = {}
+        self.dirt = None
+        self.dirt_list = []
         self.vacuum = None
         self.bar = None
+        self.dirty = True
 
     SIZE_FACT  = .9 # Max window size relative to desktop
     BAR_HEIGHT = 64 # Height of status bar
@@ -527,25 +599,30 @@ class MainGameModule(BaseModule):
         start_state, _ = self.path[0]
         final_state, _ = self.path[-1]
 
-        for y, row in enumerate(self.board_layout):
-            for x, cell in enumerate(row):
-                if (x, y) == start_state.pos:
-                    tile = self.assets.start_tile
-                elif (x, y) == final_state.pos:
-                    tile = self.assets.finish_tile
-                elif cell:
-                    tile = self.assets.default_tile
-                elif x > 0 and not self.board_layout[y, x-1]:
-                    tile = self.assets.wall_tile_mr
-                else:
-                    tile = self.assets.wall_tile_l
-                pos_x = x * self.assets.tile_size
-                pos_y = y * self.assets.tile_size
-                self.background.blit(tile, (pos_x, pos_y))
-
-                dirt_level = start_state.dirt[y, x]
-                if dirt_level:
-                    self.dirt[(x, y)] = Dirt(self.assets, (x, y), dirt_level, self.time_controller.time)
+        # Walls preceded by another wall on their left use the mid/right tile
+        wall_on_left = np.zeros_like(self.board_layout, dtype=bool)
+        wall_on_left[:, 1:] = np.logical_not(self.board_layout[:, :-1])
+        tile_index = np.where(
+                self.board_layout,
+                Assets.DEFAULT_TILE,
+                np.where(wall_on_left, Assets.WALL_TILE_MR, Assets.WALL_TILE_L))
+        start_x, start_y = start_state.pos
+        final_x, final_y = final_state.pos
+        tile_index[final_y, final_x] = Assets.FINISH_TILE
+        tile_index[start_y, start_x] = Assets.START_TILE
+
+        tile_size = self.assets.tile_size
+        ys, xs = np.indices(tile_index.shape) * tile_size
+        sources = [self.assets.tiles[i] for i in tile_index.ravel().tolist()]
+        dests = zip(xs.ravel().tolist(), ys.ravel().tolist())
+        self.background.blits(list(zip(sources, dests)), doreturn=False)
+
+        # Indexed by (y, x) like the board arrays, empty cells hold None
+        self.dirt = np.empty(self.board_layout.shape, dtype=object)
+        for y, x in zip(*np.nonzero(start_state.dirt)):
+            x, y = int(x), int(y)
+            self.dirt[y, x] = Dirt(self.assets, (x, y), start_state.dirt[y, x], self.time_controller.time)
+        self.dirt_list = [d for d in self.dirt.ravel() if d is not None]
 
         self.bar = StatusBar(Rect(0, h-self.BAR_HEIGHT, w, self.BAR_HEIGHT))
         self.vacuum = Vacuum(self.assets, start_state.pos, self.time_controller.time)
@@ -553,6 +630,8 @@ class MainGameModule(BaseModule):
         self.state_advance_timer.start()
 
     def event(self, e):
+        # Also covers window exposure and similar events
+        self.dirty = True
         if e.type == pygame.QUIT:
             raise GameQuit
         elif e.type == pygame.KEYDOWN:
@@ -573,6 +652,7 @@ class MainGameModule(BaseModule):
 
     def update(self):
         while self.state_advance_timer.tick():
+            self.dirty = True
             old_state, old_move = self.path[self.path_index]
             new_index = self.path_index + self.path_step
             if new_index not in range(len(self.path)):
@@ -586,13 +666,12 @@ class MainGameModule(BaseModule):
             if new_state.pos != old_state.pos:
                 self.vacuum.pos = new_state.pos
 
-            for y, row in enumerate(new_state.dirt):
-                for x, d in enumerate(row):
-                    if d != old_state.dirt[y, x]:
-                        self.dirt[(x, y)].level = d
-                        self.vacuum.clean()
+            for y, x in np.argwhere(new_state.dirt != old_state.dirt):
+                self.dirt[y, x].level = new_state.dirt[y, x]
+                self.vacuum.clean()
 
         if self.mode_changed:
+            self.dirty = True
             if not self.state_advance_timer.running():
                 self.bar.center_text = "* Paused *"
             elif self.path_step > 0:
@@ -602,23 +681,30 @@ class MainGameModule(BaseModule):
             self.mode_changed = False
 
         if self.speed_changed:
+            self.dirty = True
             speed = self.time_controller.speed
             if isinstance(self.time_controller.speed, Fraction):
                 speed = round(float(speed), 2)
             self.bar.right_text = f"{speed}x"
             self.speed_changed = False
 
-        for d in self.dirt.values():
-            d.update()
-        self.vacuum.update()
+        for d in self.dirt_list:
+            if d.update():
+                self.dirty = True
+        if self.vacuum.update():
+            self.dirty = True
 
     def render(self):
+        # Nothing moved, animated or changed since the last flip
+        if not self.dirty:
+            return
         self.screen.blit(self.background, (0, 0))
-        for d in self.dirt.values():
+        for d in self.dirt_list:
             d.render(self.screen)
         self.vacuum.render(self.screen)
         self.bar.render(self.screen)
         display.flip()
+        self.dirty = False
 
 
 def main(model_path, board_image_path, algorithm):
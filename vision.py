@@ -1,13 +1,12 @@
 import os
 import sys
-import gzip
 import math
 
-from io import BytesIO
 from pathlib import Path
-from statistics import mean
-from itertools import product, count
+from functools import lru_cache, partial
+from itertools import product, count, cycle
 from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
@@ -18,11 +17,10 @@ import matplotlib.pyplot as plt
 os.environ["KMP_AFFINITY"] = "noverbose"
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 
+import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import layers
 from tensorflow.keras.models import Model
-from sklearn.metrics import confusion_matrix
-from sklearn.cluster import DBSCAN
 
 
 def parse_labels(file):
@@ -40,48 +38,103 @@ def write_labels(file, labels):
             print(f"{cls} {label}", file=f)
 
 
+def confusion_matrix(true_labels, pred_labels, n_classes):
+    matrix = np.zeros((n_classes, n_classes), dtype=np.int64)
+    np.add.at(matrix, (true_labels, pred_labels), 1)
+    return matrix
+
+
+def load_dataset(file):
+    # Parsing the CSV dominates loading, so keep a decoded .npy copy next to it
+    file = Path(file)
+    name = file.name
+    for suffix in (".gz", ".csv"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    cache_file = file.with_name(name + ".npy")
+    if cache_file.exists() and cache_file.stat().st_mtime >= file.stat().st_mtime:
+        return np.load(cache_file, mmap_mode="r")
+    data = np.loadtxt(file, delimiter=",", dtype=np.uint8)
+    # Written aside and moved into place, an interrupted save never looks valid
+    tmp_file = cache_file.with_name(cache_file.name + ".tmp")
+    with open(tmp_file, "wb") as f:
+        np.save(f, data)
+    os.replace(tmp_file, cache_file)
+    return data
+
+
 class LetterRecognizerNN:
     def __init__(self, model_path=None):
+        self.model = None
+        self.interpreter = None
+        self.mixed_precision = False
         if model_path is not None:
             model_path = Path(model_path)
             self.labels = parse_labels(model_path/"classes")
-            self.model = keras.models.load_model(model_path)
+            # The quantized model serves every prediction, so the Keras one isn't loaded
+            if (model_path/"model.tflite").exists():
+                self._load_interpreter(model_path/"model.tflite")
+            else:
+                self.model = keras.models.load_model(model_path)
         else:
-            input_cnn = layers.Input(shape=(784,))
+            # fp16 compute with fp32 variables, only pays off on GPU tensor cores
+            self.mixed_precision = bool(tf.config.list_physical_devices("GPU"))
+            if self.mixed_precision:
+                keras.mixed_precision.set_global_policy("mixed_float16")
+            self.model = LetterRecognizerNN._build_model()
+            # Layers keep the policy they were built with, later models are plain fp32
+            keras.mixed_precision.set_global_policy("float32")
+
+            optimizer = keras.optimizers.Adam()
+            if self.mixed_precision:
+                optimizer = keras.mixed_precision.LossScaleOptimizer(optimizer)
+
+            self.model.compile(
+                    loss="sparse_categorical_crossentropy",
+                    optimizer=optimizer,
+                    metrics=["accuracy"])
 
-            reshaped = layers.Reshape((28, 28, 1), input_shape=(784,))(input_cnn)
+        if self.model is not None:
+            # Traced once for any batch size, so inference never retraces
+            self._infer = tf.function(
+                    lambda batch: self.model(batch, training=False),
+                    input_signature=[tf.TensorSpec((None, 784), tf.float32)])
+            self._infer(tf.zeros((1, 784)))
 
-            # cnn layers
-            cnn0 = layers.Conv2D(16, (3, 3), 1, activation="relu")(reshaped)
-            cnn1 = layers.Conv2D(32, (3, 3), 1, activation="relu")(cnn0)
-            cnn2 = layers.Conv2D(64, (3, 3), 2, padding="same", activation="relu")(cnn1)
-            poll2 = layers.MaxPooling2D((2, 2), padding="same")(cnn2)
+            self.model.summary()
 
-            # inception module
-            inception_layer = LetterRecognizerNN._inception_module(poll2, 32, 16, 32, 64, 32, 32)
+    @staticmethod
+    def _build_model():
+        input_cnn = layers.Input(shape=(784,))
 
-            # se module
-            se_layer = LetterRecognizerNN._se_module(inception_layer, 160)
+        reshaped = layers.Reshape((28, 28, 1), input_shape=(784,))(input_cnn)
 
-            # average for spatial data, remove spatial information and put the look into the feature maps, reduce computation and overfitting
-            avg = layers.GlobalAveragePooling2D()(se_layer)
+        # cnn layers
+        cnn0 = layers.Conv2D(16, (3, 3), 1, activation="relu")(reshaped)
+        cnn1 = layers.Conv2D(32, (3, 3), 1, activation="relu")(cnn0)
+        cnn2 = layers.Conv2D(64, (3, 3), 2, padding="same", activation="relu")(cnn1)
+        poll2 = layers.MaxPooling2D((2, 2), padding="same")(cnn2)
 
-            # mlp
-            dense1 = layers.Dense(64, activation="relu")(avg)
-            drop1 = layers.Dropout(.3)(dense1)
-            dense2 = layers.Dense(64, activation="relu")(drop1)
-            drop2 = layers.Dropout(.3)(dense2)
-            dense3 = layers.Dense(32, activation="relu")(drop2)
-            drop3 = layers.Dropout(.3)(dense3)
-            output = layers.Dense(6, activation="softmax")(drop3)
+        # inception module
+        inception_layer = LetterRecognizerNN._inception_module(poll2, 32, 16, 32, 64, 32, 32)
 
-            self.model = Model(inputs=input_cnn, outputs=output)
-            self.model.compile(
-                    loss="sparse_categorical_crossentropy",
-                    optimizer="adam",
-                    metrics=["accuracy"])
+        # se module
+        se_layer = LetterRecognizerNN._se_module(inception_layer, 160)
+
+        # average for spatial data, remove spatial information and put the look into the feature maps, reduce computation and overfitting
+        avg = layers.GlobalAveragePooling2D()(se_layer)
+
+        # mlp
+        dense1 = layers.Dense(64, activation="relu")(avg)
+        drop1 = layers.Dropout(.3)(dense1)
+        dense2 = layers.Dense(64, activation="relu")(drop1)
+        drop2 = layers.Dropout(.3)(dense2)
+        dense3 = layers.Dense(32, activation="relu")(drop2)
+        drop3 = layers.Dropout(.3)(dense3)
+        # softmax and crossentropy are numerically unstable in fp16
+        output = layers.Dense(6, activation="softmax", dtype="float32")(drop3)
 
-        self.model.summary()
+        return Model(inputs=input_cnn, outputs=output)
 
     @staticmethod
     def _se_module(input, levels, factor=16):
@@ -109,30 +162,42 @@ class LetterRecognizerNN:
         dataset_path = Path(dataset_path)
         self.labels = parse_labels(dataset_path/"classes")
 
-        with gzip.open(dataset_path/"training.csv.gz") as f:
-            train = np.genfromtxt(f, delimiter=",")
+        train = load_dataset(dataset_path/"training.csv.gz")
+        test = load_dataset(dataset_path/"testing.csv.gz")
 
-        with gzip.open(dataset_path/"testing.csv.gz") as f:
-            test = np.genfromtxt(f, delimiter=",")
+        train_imgs = train[:, 1:].astype(np.float32) * (1/255)
+        train_labels = np.array(train[:, 0])
+        test_imgs = test[:, 1:].astype(np.float32) * (1/255)
+        test_labels = np.array(test[:, 0])
 
-        train_imgs = train[:, 1:]/255
-        train_labels = train[:, 0].astype(np.uint8)
-        test_imgs = test[:, 1:]/255
-        test_labels = test[:, 0].astype(np.uint8)
+        # Batching and shuffling overlap with training instead of stalling it
+        train_ds = (tf.data.Dataset.from_tensor_slices((train_imgs, train_labels))
+                .shuffle(len(train_imgs))
+                .batch(batch_size)
+                .prefetch(tf.data.AUTOTUNE))
+        test_ds = (tf.data.Dataset.from_tensor_slices((test_imgs, test_labels))
+                .batch(batch_size)
+                .prefetch(tf.data.AUTOTUNE))
 
         history = self.model.fit(
-                train_imgs,
-                train_labels,
-                batch_size=batch_size,
+                train_ds,
                 epochs=epochs,
-                validation_data=(test_imgs, test_labels))
+                validation_data=test_ds)
 
         if model_path is not None:
             model_path = Path(model_path)
-            self.model.save(model_path)
+            export_model = self.model
+            if self.mixed_precision:
+                # An fp16 model would run emulated on CPU-only players and can't be quantized
+                export_model = LetterRecognizerNN._build_model()
+                export_model.set_weights(self.model.get_weights())
+            export_model.save(model_path)
             write_labels(model_path/"classes", self.labels)
+            self.save_quantized(export_model, model_path/"model.tflite", train_imgs)
+            if (model_path/"model.tflite").exists():
+                self._load_interpreter(model_path/"model.tflite")
 
-        score = self.model.evaluate(test_imgs, test_labels, verbose=0)
+        score = self.model.evaluate(test_ds, verbose=0)
 
         loss = score[0]
         accuracy = score[1]
@@ -140,16 +205,25 @@ class LetterRecognizerNN:
         print("Test loss:", loss)
         print("Test accuracy:", accuracy)
 
+        # The game predicts with the quantized model, so its accuracy is the one that matters
+        quantized_accuracy = None
+        if self.interpreter is not None:
+            pred_test_labels = np.argmax(self._invoke_interpreter(test_imgs), axis=1)
+            quantized_accuracy = np.mean(pred_test_labels == test_labels)
+            print("Quantized test accuracy:", quantized_accuracy)
+
         if os.getenv("VACUUM_GENERATE_REPORT"):
             with open("report.md", "w") as f, redirect_stdout(f):
                 print("# Metrics")
                 print(f"Loss: {loss}")
                 print(f"Accuracy: {accuracy}")
+                if quantized_accuracy is not None:
+                    print(f"Quantized accuracy: {quantized_accuracy}")
 
             pred_test_labels = self.model.predict(test_imgs)
             pred_test_labels = np.argmax(pred_test_labels, axis=1)
 
-            plt.imshow(confusion_matrix(test_labels, pred_test_labels), cmap=plt.cm.Blues)
+            plt.imshow(confusion_matrix(test_labels, pred_test_labels, len(self.labels)), cmap=plt.cm.Blues)
             plt.xlabel("Predicted labels")
             plt.ylabel("True labels")
             plt.title("Confusion matrix")
@@ -179,15 +253,65 @@ class LetterRecognizerNN:
             except ImportError as e:
                 print("Could not generate graphic model representation (model.png):", "".join(e.args[0]))
 
-    def predict(self, image):
+    @staticmethod
+    def save_quantized(model, file, sample_imgs):
+        # Not part of the public API, imported here so a relocation only affects training
+        from tensorflow.lite.python.convert import ConverterError
+
+        def representative_dataset():
+            for i in range(min(100, len(sample_imgs))):
+                yield [sample_imgs[i:i+1]]
+
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        # A model.tflite left from an earlier run would shadow the model just saved
+        file = Path(file)
+        file.unlink(missing_ok=True)
+        try:
+            quantized = converter.convert()
+        except ConverterError as e:
+            print("Could not generate quantized model (model.tflite):", e)
+            return
+        file.write_bytes(quantized)
+
+    def _load_interpreter(self, file):
+        self.interpreter = tf.lite.Interpreter(model_path=str(file))
+        self.interpreter_shape = None
+
+    def _invoke_interpreter(self, batch):
+        input_index = self.interpreter.get_input_details()[0]["index"]
+        output_index = self.interpreter.get_output_details()[0]["index"]
+        # Reallocating is only needed when the batch size changes
+        if batch.shape != self.interpreter_shape:
+            self.interpreter.resize_tensor_input(input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self.interpreter_shape = batch.shape
+        self.interpreter.set_tensor(input_index, batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(output_index)
+
+    @staticmethod
+    def _prepare(image):
         if len(image.shape) > 2:
             image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         image = cv2.resize(image, (28, 28))
         visualize("To neural network", image)
-        image = image.flatten() / 255
-        return np.argmax(
-                self.model.predict(
-                    np.array([image])))
+        return image.reshape(784) * np.float32(1/255)
+
+    def predict_batch(self, images):
+        batch = np.empty((len(images), 784), dtype=np.float32)
+        for i, image in enumerate(images):
+            batch[i] = self._prepare(image)
+        if self.interpreter is not None:
+            scores = self._invoke_interpreter(batch)
+        else:
+            scores = self._infer(batch).numpy()
+        return np.argmax(scores, axis=1)
+
+    def predict(self, image):
+        return self.predict_batch([image])[0]
 
 
 def adjacent_pairs(seq):
@@ -206,6 +330,7 @@ if debug_dir:
     debug_dir = Path(debug_dir)
     debug_dir.mkdir(exist_ok=True)
 visualize_index = count()
+DEBUG = bool(debug_output or debug_dir)
 
 def visualize(title, image):
     if debug_dir:
@@ -221,6 +346,8 @@ def visualize(title, image):
                 return
 
 
+# OpenCV never writes to kernels, so a single array per size can be shared
+@lru_cache(maxsize=None)
 def square_kern(n):
     return cv2.getStructuringElement(cv2.MORPH_RECT, (n, n))
 
@@ -246,38 +373,113 @@ def draw_line(image, line, color, thickness=1):
     return cv2.line(image, p1, p2, color, thickness)
 
 
-def plt_fig_to_image(fig, dpi=90):
-    with BytesIO() as buf:
-        fig.savefig(buf, format="png", dpi=dpi)
-        buf.seek(0)
-        image = np.frombuffer(buf.getvalue(), dtype=np.uint8)
-    return cv2.imdecode(image, 1)
+PLOT_SIZE = (432, 576)
+PLOT_MARGIN = 48
+# Matplotlib's default color cycle, in BGR
+PLOT_COLORS = [
+        (180, 119, 31), (14, 127, 255), (44, 160, 44), (40, 39, 214), (189, 103, 148),
+        (75, 86, 140), (194, 119, 227), (127, 127, 127), (34, 189, 188), (207, 190, 23)]
+
+
+def draw_text(canvas, text, center, scale=0.5):
+    (w, h), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, 1)
+    x, y = center
+    cv2.putText(canvas, text, (x - w//2, y + h//2), cv2.FONT_HERSHEY_SIMPLEX, scale, (0, 0, 0), 1, cv2.LINE_AA)
+
+
+def draw_tick(canvas, value, point, below, scale=0.4, gap=4):
+    # Placed just outside the frame, below it or to its left
+    text = f"{value:.3g}"
+    (w, h), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, 1)
+    x, y = point
+    if below:
+        y += gap + h//2
+    else:
+        # Shrunk when wider than the margin, so it is not clipped at the canvas edge
+        room = PLOT_MARGIN - 2*gap
+        if w > room:
+            scale *= room / w
+            w = room
+        x -= gap + w//2
+    draw_text(canvas, text, (x, y), scale)
+
+
+def plot_canvas(title, xlabel, ylabel, low, high, pad=0):
+    h, w = PLOT_SIZE
+    (x0, y0), (x1, y1) = low, high
+    canvas = np.full((h, w, 3), 255, np.uint8)
+    cv2.rectangle(canvas, (PLOT_MARGIN, PLOT_MARGIN), (w-PLOT_MARGIN, h-PLOT_MARGIN), (0, 0, 0))
+    draw_text(canvas, title, (w//2, PLOT_MARGIN//2))
+    draw_text(canvas, xlabel, (w//2, h - PLOT_MARGIN//3))
+    edge = PLOT_MARGIN + pad
+    draw_tick(canvas, x0, (edge, h - PLOT_MARGIN), below=True)
+    draw_tick(canvas, x1, (w - edge, h - PLOT_MARGIN), below=True)
+    draw_tick(canvas, y0, (PLOT_MARGIN, h - edge), below=False)
+    draw_tick(canvas, y1, (PLOT_MARGIN, edge), below=False)
+    # The y label reads upwards, so it is drawn on the canvas turned on its side
+    canvas = cv2.rotate(canvas, cv2.ROTATE_90_CLOCKWISE)
+    draw_text(canvas, ylabel, (h//2, PLOT_MARGIN//3))
+    return cv2.rotate(canvas, cv2.ROTATE_90_COUNTERCLOCKWISE)
+
+
+def plot_transform(low, high, pad=0):
+    h, w = PLOT_SIZE
+    low = np.asarray(low, np.float64)
+    span = np.maximum(np.asarray(high, np.float64) - low, np.finfo(np.float64).eps)
+    scale = (np.array([w, h]) - 2*(PLOT_MARGIN + pad)) / span * (1, -1)
+    origin = np.array([PLOT_MARGIN + pad, h - PLOT_MARGIN - pad])
+    return lambda points: (origin + (points - low)*scale).round().astype(np.int32)
 
 
 def scatter_plot(title, xlabel, ylabel, *points, big=False):
-    fig, ax = plt.subplots()
-    ax.set_title(title)
-    ax.set_xlabel(xlabel)
-    ax.set_ylabel(ylabel)
-    for ps in points:
-        ps = np.array(ps)
-        xs, ys = ps.T
-        size = 128 if big else 16
-        ax.scatter(xs, ys, s=size, marker=".")
-    visualize(title, plt_fig_to_image(fig))
+    if not DEBUG:
+        return
+    points = [np.asarray(ps, np.float64).reshape(-1, 2) for ps in points]
+    all_points = np.concatenate(points)
+    low, high = all_points.min(axis=0), all_points.max(axis=0)
+    radius = 6 if big else 2
+    canvas = plot_canvas(title, xlabel, ylabel, low, high, pad=PLOT_MARGIN//2)
+    to_canvas = plot_transform(low, high, pad=PLOT_MARGIN//2)
+    for ps, color in zip(points, cycle(PLOT_COLORS)):
+        for center in map(tuple, to_canvas(ps).tolist()):
+            cv2.circle(canvas, center, radius, color, -1, cv2.LINE_AA)
+    visualize(title, canvas)
 
 
 def histogram(title, image, *vlines):
-    fig, ax = plt.subplots()
-    ax.set_title(title)
-    ax.hist(image.flatten(), 256, (0, 256), color="black")
+    if not DEBUG:
+        return
+    counts = cv2.calcHist([image], [0], None, [256], [0, 256]).ravel()
+    low, high = (0, 0), (256, counts.max())
+    canvas = plot_canvas(title, "", "", low, high)
+    to_canvas = plot_transform(low, high)
+    bins = np.arange(256)
+    bottom_lefts = to_canvas(np.column_stack((bins, np.zeros(256)))).tolist()
+    top_rights = to_canvas(np.column_stack((bins + 1, counts))).tolist()
+    for (x0, y0), (x1, y1) in zip(bottom_lefts, top_rights):
+        cv2.rectangle(canvas, (x0, y0), (x1, y1), (0, 0, 0), -1)
     for x in vlines:
-        ax.axvline(x, color="red")
-    visualize(title, plt_fig_to_image(fig))
+        (x, top), (_, bottom) = to_canvas(np.array([(x, high[1]), (x, 0)])).tolist()
+        cv2.line(canvas, (x, top), (x, bottom), (0, 0, 255))
+    visualize(title, canvas)
+
+
+def cluster_points(points, eps):
+    # Same clusters as DBSCAN with min_samples=1: the connected components
+    # of the graph joining points at most eps apart
+    distances = np.linalg.norm(points[:, np.newaxis] - points[np.newaxis], axis=-1)
+    neighbours = distances <= eps
+    labels = np.arange(len(points))
+    while True:
+        # Spread the smallest label through each component
+        new_labels = np.where(neighbours, labels, len(points)).min(axis=1)
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
 
 
 def mean_line(lines):
-    return np.apply_along_axis(mean, 0, np.array(lines))
+    return np.mean(np.asarray(lines), axis=0)
 
 
 def mean_lines(lines):
@@ -285,9 +487,9 @@ def mean_lines(lines):
             "Raw Hough transform data",
             "Rho", "Theta", lines)
     lines = np.array(lines)
-    for i, (rho, theta) in enumerate(lines):
-        if theta > np.pi*3/4:
-            lines[i] = -rho, theta-np.pi
+    flipped = lines[:, 1] > np.pi*3/4
+    lines[flipped, 0] *= -1
+    lines[flipped, 1] -= np.pi
 
     scatter_plot(
             "Rectified Hough transform data",
@@ -301,28 +503,25 @@ def mean_lines(lines):
             "Scaled rectified Hough transform data",
             "Rho", "Theta", scaled_lines)
 
-    model = DBSCAN(eps=24, min_samples=1)
-    model.fit(scaled_lines)
+    labels = cluster_points(scaled_lines, eps=24)
 
-    clusters = {}
-    for label, line in zip(model.labels_, lines):
-        clusters.setdefault(label, []).append(line)
+    order = np.argsort(labels, kind="stable")
+    _, splits = np.unique(labels[order], return_index=True)
+    clusters = np.split(lines[order], splits[1:])
 
     scatter_plot(
-            "DBSCAN clustered Hough transform data",
-            "Rho", "Theta", *clusters.values())
+            "Clustered Hough transform data",
+            "Rho", "Theta", *clusters)
 
-    mean_lines = []
-    for label, line_cluster in clusters.items():
-        mean_lines.append(mean_line(line_cluster))
+    mean_lines = np.stack([mean_line(line_cluster) for line_cluster in clusters])
 
     scatter_plot(
             "Per-cluster mean of Hough transform data",
             "Rho", "Theta", *map(list, mean_lines), big=True)
 
-    for i, (rho, theta) in enumerate(mean_lines):
-        if theta < 0:
-            mean_lines[i] = -rho, theta+np.pi
+    flipped = mean_lines[:, 1] < 0
+    mean_lines[flipped, 0] *= -1
+    mean_lines[flipped, 1] += np.pi
 
     return mean_lines
 
@@ -342,69 +541,45 @@ def line_intersection(l1, l2):
         raise ValueError("l1 and l2 are parallel")
 
 
-def point_distance(p1, p2):
-    x1, y1 = p1
-    x2, y2 = p2
-    return math.sqrt((x1-x2)**2 + (y1-y2)**2)
-
-
-def distance_from_border(image, point):
-    x, y = point
-    h, w, *_ = image.shape
-    return min(x, w-x-1, y, h-y-1)
+def distance_from_border(shape):
+    h, w, *_ = shape
+    ys, xs = np.ogrid[:h, :w]
+    return np.minimum(np.minimum(xs, w-xs-1), np.minimum(ys, h-ys-1))
 
 
 def largest_blob(image):
-    h, w = image.shape
-    search_image = cv2.bitwise_and(image, 64)
-    visualize("Finding largest blob", search_image)
-    best_area = 0
-    largest_blob = None
-    for y, x in product(range(h), range(w)):
-        if not search_image[y, x]:
-            continue
-        area, filled, _, _ = cv2.floodFill(search_image, None, (x, y), 255)
-        visualize(f"Blob found at {(x, y)}", filled)
-        if area > best_area:
-            best_area = area
-            largest_blob = np.copy(filled)
-        _, search_image, _, _ = cv2.floodFill(search_image, None, (x, y), 0)
-    _, largest_blob = cv2.threshold(largest_blob, 127, 255, cv2.THRESH_BINARY)
-    return largest_blob
+    visualize("Finding largest blob", image)
+    # Blobs are 4-connected, as cv2.floodFill fills them
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(image, connectivity=4)
+    # Label 0 is the background
+    best_label = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    return (labels == best_label) * np.uint8(255)
 
 
 def score_blob(image, blob_color=255):
-    h, w, *_ = image.shape
-    return sum(
-            distance_from_border(image, (x, y))
-            for y, x in product(range(h), range(w))
-            if image[y, x] == blob_color)
+    return int(distance_from_border(image.shape)[image == blob_color].sum())
 
 
 def main_blob(image):
     h, w, *_ = image.shape
     min_area = (min(h, w)//10)**2
-    image = cv2.bitwise_and(image, 64)
-    best_blob = None
+    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(image, connectivity=4)
+    best_label = None
     best_score = 0
-    for y, x in product(range(h), range(w)):
-        if not image[y, x]:
-            continue
-        area, _, _, _ = cv2.floodFill(image, None, (x, y), 255)
-        if area > min_area:
-            blob_score = score_blob(image, blob_color=255)
+    for label in range(1, n_labels):
+        if stats[label, cv2.CC_STAT_AREA] > min_area:
+            blob_score = score_blob(labels, blob_color=label)
             if blob_score > best_score:
                 best_score = blob_score
-                _, best_blob = cv2.threshold(image, 127, 255, cv2.THRESH_BINARY)
-        cv2.floodFill(image, None, (x, y), 0)
-    return best_blob
+                best_label = label
+    if best_label is None:
+        return None
+    return (labels == best_label) * np.uint8(255)
 
 
 def trim_to_content(image):
-    h, w, *_ = image.shape
-    x, y = w, h
-    contours, _ = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-    x, y, w, h = cv2.boundingRect(np.concatenate(contours))
+    # On an 8-bit image boundingRect bounds the nonzero pixels in one pass
+    x, y, w, h = cv2.boundingRect(image)
     return image[y:y+h, x:x+w]
 
 
@@ -419,25 +594,51 @@ def frame(image, relative_size):
 
 
 def smooth_out(image):
-    for i in range(4):
-        image = cv2.medianBlur(image, 3)
+    # A 5x5 then a 3x3 median stand in for four repeated 3x3 medians
+    image = cv2.medianBlur(image, 5)
+    image = cv2.medianBlur(image, 3)
     image = cv2.pyrUp(image)
     image = cv2.blur(image, (3, 3))
     return image
 
 
 def alpha_beta_correction(image, alpha, beta):
-    image = image.astype(np.float32)
-    return np.clip(image*alpha + beta, 0, 255).astype(np.uint8)
+    lookup_table = np.arange(256, dtype=np.float32)
+    lookup_table = np.clip(lookup_table*alpha + beta, 0, 255)
+    lookup_table = lookup_table.astype(np.uint8)
+    return cv2.LUT(image, lookup_table)
 
 
 def gamma_correction(image, gamma):
-    lookup_table = np.arange(256).reshape((1, 256))
+    lookup_table = np.arange(256, dtype=np.float32)
     lookup_table = np.clip((lookup_table/255)**gamma * 255, 0, 255)
     lookup_table = lookup_table.astype(np.uint8)
     return cv2.LUT(image, lookup_table)
 
 
+def extract_letter(image, cell_transform, cell_size):
+    cell = cv2.warpPerspective(image, cell_transform, cell_size, flags=cv2.INTER_LINEAR)
+    visualize("Grid cell", cell)
+    cell = cv2.GaussianBlur(cell, (5, 5), 0)
+    visualize("Gaussian blur", cell)
+    value, cell = cv2.threshold(cell, 0, 255, cv2.THRESH_BINARY_INV|cv2.THRESH_OTSU)
+    visualize(f"Otsu's threshold ({value})", cell)
+    cell = cv2.morphologyEx(cell, cv2.MORPH_OPEN, square_kern(2))
+    visualize("Morphological opening", cell)
+    letter = main_blob(cell)
+    if DEBUG:
+        figure = cv2.cvtColor(cell, cv2.COLOR_GRAY2BGR)
+        figure[letter == 255] = (0, 0, 255)
+        visualize("Main blob", figure)
+    letter = trim_to_content(letter)
+    visualize("Trim", letter)
+    letter = frame(letter, 1.5)
+    visualize("Frame", letter)
+    letter = smooth_out(letter)
+    visualize("Smooth out", letter)
+    return letter
+
+
 def read_board(file, model):
     image = cv2.imread(file, cv2.IMREAD_GRAYSCALE)
     visualize("Original image", image)
@@ -453,23 +654,21 @@ def read_board(file, model):
     image = cv2.GaussianBlur(image, (11, 11), 0)
     image = cv2.GaussianBlur(image, (11, 11), 0)
     visualize("Double gaussian blur", image)
-    image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 9, 5)
+    image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 9, 5)
     visualize("Adaptive threshold", image)
-    image = 255-image
-    visualize("Invert", image)
     image = cv2.morphologyEx(image, cv2.MORPH_CLOSE, square_kern(6))
     visualize("Morphological closing", image)
     image = cv2.morphologyEx(image, cv2.MORPH_OPEN, square_kern(2))
     visualize("Morphological opening", image)
 
     contours, _ = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-    figure = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-    figure = cv2.drawContours(figure, contours, -1, (255, 0, 0), 3)
-    visualize("External contours", figure)
-
     x, y, w, h = max((cv2.boundingRect(c) for c in contours), key=rect_area)
-    figure = cv2.rectangle(figure, (x, y), (x+w, y+h), (0, 0, 255), 3)
-    visualize("Main contour bounding box", figure)
+    if DEBUG:
+        figure = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        figure = cv2.drawContours(figure, contours, -1, (255, 0, 0), 3)
+        visualize("External contours", figure)
+        figure = cv2.rectangle(figure, (x, y), (x+w, y+h), (0, 0, 255), 3)
+        visualize("Main contour bounding box", figure)
 
     image = image[y:y+h, x:x+w]
     corrected_image = corrected_image[y:y+h, x:x+w]
@@ -480,16 +679,18 @@ def read_board(file, model):
 
     lines = cv2.HoughLines(grid, 1, np.pi/180, 200)
     lines = lines[:, 0, :]
-    figure = cv2.cvtColor(grid, cv2.COLOR_GRAY2BGR)
-    for line in lines:
-        figure = draw_line(figure, line, (0, 0, 255))
-    visualize("Hough transform of grid", figure)
+    if DEBUG:
+        figure = cv2.cvtColor(grid, cv2.COLOR_GRAY2BGR)
+        for line in lines:
+            figure = draw_line(figure, line, (0, 0, 255))
+        visualize("Hough transform of grid", figure)
 
     lines = mean_lines(lines)
-    figure = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-    for line in lines:
-        figure = draw_line(figure, line, (0, 0, 255), 3)
-    visualize("Clusterized mean Hough transform", figure)
+    if DEBUG:
+        figure = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        for line in lines:
+            figure = draw_line(figure, line, (0, 0, 255), 3)
+        visualize("Clusterized mean Hough transform", figure)
 
     horizontal_lines = []
     vertical_lines = []
@@ -513,57 +714,57 @@ def read_board(file, model):
     _, bottom_line = max(horizontal_lines)
 
     lines = [top_line, left_line, bottom_line, right_line]
-    for line in lines:
-        figure = draw_line(figure, line, (255, 0, 0), 3)
-    visualize("Grid edge lines", figure)
-
     intersections = [line_intersection(l1, l2) for l1, l2 in adjacent_pairs(lines)]
-    for x, y in intersections:
-        cv2.circle(figure, (x, y), 9, (0, 255, 0), -1)
-    visualize("Grid corner points", figure)
-
-    top_left, bottom_left, bottom_right, top_right = intersections
-    w = int(max(point_distance(p1, p2) for p1, p2 in ((top_left, top_right), (bottom_left, bottom_right))))
-    h = int(max(point_distance(p1, p2) for p1, p2 in ((top_left, bottom_left), (top_right, bottom_right))))
-
+    if DEBUG:
+        for line in lines:
+            figure = draw_line(figure, line, (255, 0, 0), 3)
+        visualize("Grid edge lines", figure)
+        for x, y in intersections:
+            cv2.circle(figure, (x, y), 9, (0, 255, 0), -1)
+        visualize("Grid corner points", figure)
+
+    # Corners run top left, bottom left, bottom right, top right
     src = np.array(intersections, dtype=np.float32)
+    w = int(np.linalg.norm(src[[0, 1]] - src[[3, 2]], axis=1).max())
+    h = int(np.linalg.norm(src[[0, 3]] - src[[1, 2]], axis=1).max())
+
     dst = np.array([[0, 0], [0, h-1], [w-1, h-1], [w-1, 0]], dtype=np.float32)
     transform_matrix = cv2.getPerspectiveTransform(src, dst)
-    image = cv2.warpPerspective(corrected_image, transform_matrix, (w, h), flags=cv2.INTER_LINEAR)
-    visualize("Perspective correction of original image", image)
+    if DEBUG:
+        image = cv2.warpPerspective(corrected_image, transform_matrix, (w, h), flags=cv2.INTER_LINEAR)
+        visualize("Perspective correction of original image", image)
 
-    classes = np.zeros((n, m), dtype=np.uint8)
+    cell_transforms = []
+    cell_sizes = []
 
-    cell_h = h/n
-    cell_w = w/m
+    # Adjacent cells share their edges, so there are no gaps or overlaps
+    y_edges = np.linspace(0, h, n+1, dtype=np.int32).tolist()
+    x_edges = np.linspace(0, w, m+1, dtype=np.int32).tolist()
     for i, j in product(range(n), range(m)):
-        cell_y = int(i*cell_h)
-        cell_x = int(j*cell_w)
-        cell = image[
-                cell_y:cell_y+int(cell_h),
-                cell_x:cell_x+int(cell_w)]
-        visualize("Grid cell", cell)
-        cell = cv2.GaussianBlur(cell, (5, 5), 0)
-        visualize("Gaussian blur", cell)
-        value, cell = cv2.threshold(cell, 0, 255, cv2.THRESH_BINARY|cv2.THRESH_OTSU)
-        visualize(f"Otsu's threshold ({value})", cell)
-        cell = 255-cell
-        visualize("Invert", cell)
-        cell = cv2.morphologyEx(cell, cv2.MORPH_OPEN, square_kern(2))
-        visualize("Morphological opening", cell)
-        letter = main_blob(cell)
-        figure = cv2.cvtColor(cell, cv2.COLOR_GRAY2BGR)
-        figure[letter == 255] = (0, 0, 255)
-        visualize("Main blob", figure)
-        letter = trim_to_content(letter)
-        visualize("Trim", letter)
-        letter = frame(letter, 1.5)
-        visualize("Frame", letter)
-        letter = smooth_out(letter)
-        visualize("Smooth out", letter)
-        classes[i, j] = model.predict(letter)
-
-    return classes
+        x0, x1 = x_edges[j], x_edges[j+1]
+        y0, y1 = y_edges[i], y_edges[i+1]
+        # The board transform shifted to the cell origin warps only that cell
+        cell_transform = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]]) @ transform_matrix
+        cell_transforms.append(cell_transform)
+        cell_sizes.append((x1-x0, y1-y0))
+
+    extract = partial(extract_letter, corrected_image)
+    if DEBUG:
+        # The debug window is driven from this thread, one cell at a time
+        letters = list(map(extract, cell_transforms, cell_sizes))
+    else:
+        # Cells are independent and OpenCV releases the GIL, so spread them
+        # over threads and keep OpenCV itself from oversubscribing the cores
+        n_threads = cv2.getNumThreads()
+        cv2.setNumThreads(1)
+        try:
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                letters = list(executor.map(extract, cell_transforms, cell_sizes))
+        finally:
+            cv2.setNumThreads(n_threads)
+
+    classes = model.predict_batch(letters)
+    return classes.reshape((n, m)).astype(np.uint8)
 
 
 def print_board(board, labels):